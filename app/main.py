@@ -7,8 +7,8 @@ from fastapi.responses import RedirectResponse, FileResponse
 from sqlalchemy.orm import Session
 
 from persistence.models import Base
-from persistence.database import engine, SessionLocal
-from persistence import crud
+from persistence.database import active_engines, new_session
+from persistence import crud, vin_filter
 from services import vPIC
 
 
@@ -19,7 +19,7 @@ app = FastAPI()
 # Dependency
 def get_db():
     try:
-        db = SessionLocal()
+        db = new_session()
         yield db
     finally:
         db.close()
@@ -32,8 +32,33 @@ def startup_event():
     Create DB tables
     '''
 
-    # Create DB tables 
-    Base.metadata.create_all(bind=engine)
+    # Create DB tables on the db file or every shard
+    for engine in active_engines:
+        Base.metadata.create_all(bind=engine)
+
+    # Load the VIN membership filter from its snapshot or rebuild it from the DB.
+    # Only when enabled, as it is only correct with a single writer per DB
+    if vin_filter.FILTER_ENABLED:
+        db = new_session()
+        try:
+            vin_filter.load_or_build(db)
+        finally:
+            db.close()
+
+
+@app.on_event('shutdown')
+def shutdown_event():
+    '''
+    App shutdown event.
+    Snapshot the VIN membership filter so the next startup can skip the rebuild
+    '''
+
+    if vin_filter.FILTER_ENABLED:
+        db = new_session()
+        try:
+            vin_filter.save_snapshot(db)
+        finally:
+            db.close()
 
 
 #################### ENDPOINTS ####################
@@ -66,8 +91,9 @@ async def lookup(db: Session = Depends(get_db), vin: str = Path(regex="^[A-Za-z0
         # If we have a valid response from the api
         if vin_dto is not None:
 
-            # Save VIN record for future use in cache
-            await crud.create_vin(db, vin_dto)
+            # Save VIN record for future use in cache.
+            # Returns the cached record instead if the vin turned out to be cached already
+            vin_dto = await crud.create_vin(db, vin_dto)
 
             # Return the VIN DTO as a response
             return vin_dto
@@ -105,6 +131,14 @@ async def remove(db: Session = Depends(get_db), vin: str = Path(regex="^[A-Za-z0
         return {"VIN":vin, "cache_delete_success":False}
 
 
+@app.get('/filter/stats')
+def filter_stats():
+    '''
+    Return memory use and false positive rate of the VIN membership filter
+    '''
+    return vin_filter.vin_filter.stats()
+
+
 @app.get('/export', response_class=FileResponse)
 async def export(background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
     '''
@@ -1,11 +1,14 @@
 import tempfile
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
-from fastparquet import write
-import pandas as pd
 from . import models, schemas
+from .database import session_for, sessions_of
+from .vin_filter import vin_filter
 
 '''
 CRUD methods for the database session
+The session can also be a ShardedSession, point operations are routed to the shard of the vin
+and batch queries fan out to every shard
 '''
 
 async def get_by_vin(db: Session, vin_num: str) -> models.VINInfo:
@@ -13,7 +16,12 @@ async def get_by_vin(db: Session, vin_num: str) -> models.VINInfo:
     Get a VINInfo model obj from the DB based on vin_num
     Returns None if it does not exist, otherwise returns VINInfo model obj
     '''
-    vin_model = db.query(models.VINInfo).filter(models.VINInfo.vin == vin_num).first()
+
+    # Skip the query when the filter says the vin is definitely not cached
+    if not vin_filter.might_contain(vin_num):
+        return None
+
+    vin_model = session_for(db, vin_num).query(models.VINInfo).filter(models.VINInfo.vin == vin_num).first()
 
     if vin_model is not None:
         return vin_model
@@ -30,8 +38,13 @@ async def delete_vin(db: Session, vin: str) -> bool:
 
     # Try to delete item
     try:
-        count = db.query(models.VINInfo).filter(models.VINInfo.vin == vin).delete()
-        db.commit()
+        shard_db = session_for(db, vin)
+        count = shard_db.query(models.VINInfo).filter(models.VINInfo.vin == vin).delete()
+        shard_db.commit()
+
+        # Only remove vins that were actually cached so the filter counters stay consistent
+        if count > 0 and vin_filter.ready:
+            vin_filter.remove(vin)
 
         return True if count > 0 else False
     except Exception as e:
@@ -40,10 +53,11 @@ async def delete_vin(db: Session, vin: str) -> bool:
 
 
 
-async def create_vin(db: Session, vin: schemas.VINInfoBase) -> models.VINInfo:
+async def create_vin(db: Session, vin: schemas.VINInfoGet) -> schemas.VINInfoGet:
     '''
     Create VIN
-    Returns a VinInfo model obj
+    Returns the VIN DTO that was saved, or the already cached record as a VINInfoGet DTO
+    if the vin was cached by a writer the filter did not see
     '''
 
     # Create vin model obj and pre set cached to true 
@@ -52,13 +66,34 @@ async def create_vin(db: Session, vin: schemas.VINInfoBase) -> models.VINInfo:
 
     # Add model and commit and refresh
     try:
-        db.add(vin_info)
-        db.commit()
-        db.refresh(vin_info)
+        shard_db = session_for(db, vin_info.vin)
+        shard_db.add(vin_info)
+        shard_db.commit()
+        shard_db.refresh(vin_info)
+
+        # Keep the membership filter in sync with the cache, once it is in use
+        if vin_filter.ready:
+            vin_filter.add(vin_info.vin)
 
         # Return base class
         return vin
 
+    except IntegrityError as e:
+        shard_db.rollback()
+
+        # The vin is already cached, e.g. written by another process the filter does not know about
+        cached_vin = shard_db.query(models.VINInfo).filter(models.VINInfo.vin == vin_info.vin).first()
+        if cached_vin is None:
+            print("Error saving vin to DB. {}".format(e))
+            raise e
+
+        # Only add definite misses, a vin the filter already matches would be counted twice.
+        # might_contain is always True while the filter is not ready, so nothing is added then
+        if not vin_filter.might_contain(cached_vin.vin):
+            vin_filter.add(cached_vin.vin)
+
+        return schemas.VINInfoGet.from_orm(cached_vin)
+
     except Exception as e:
         print("Error saving vin to DB. {}".format(e))
         raise e
@@ -68,11 +103,15 @@ async def create_vin(db: Session, vin: schemas.VINInfoBase) -> models.VINInfo:
 async def export_db(db: Session) -> list:
     '''
     Export the cache of VIN's as a list. 
+    Merges the rows of every shard when sharded
     '''
 
     try:
 
-        cache_list = db.query(models.VINInfo).with_entities(models.VINInfo.vin, models.VINInfo.make, models.VINInfo.model, models.VINInfo.model_year, models.VINInfo.body_class)
+        cache_list = []
+        for shard_db in sessions_of(db):
+            cache_list.extend(shard_db.query(models.VINInfo).with_entities(models.VINInfo.vin, models.VINInfo.make, models.VINInfo.model, models.VINInfo.model_year, models.VINInfo.body_class))
+
         return cache_list
     except Exception as e:
         raise e
@@ -86,6 +125,10 @@ async def db_to_parquet(db: Session) -> str:
     Refer to https://github.com/dask/fastparquet/
     '''
 
+    # Import the export stack here so workers only pay for pandas/fastparquet on the first export
+    from fastparquet import write
+    import pandas as pd
+
     try:
         
         # Filename 
@@ -1,7 +1,9 @@
+import os
+from hashlib import blake2b
 from sqlite3 import connect
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
 
 # For prod/dev
 
@@ -20,6 +22,111 @@ Base = declarative_base()
 
 
 
+# Sharded storage
+
+# Number of SQLite shard files, 0 keeps everything in the single db file above
+SHARD_COUNT = int(os.environ.get("VIN_DB_SHARDS", "0"))
+
+# SQLITE shard file path template, formatted with the shard index
+SQLALCHEMY_SHARD_DATABASE_URL = "sqlite:///./vin_shard_{}.db"
+
+
+def shard_for(vin: str, shard_count: int) -> int:
+    '''
+    Shard index for a vin.
+    Uses a stable hash so every process routes a vin to the same shard
+    '''
+    digest = blake2b(vin.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little") % shard_count
+
+
+def create_shard_engines(url_template: str, shard_count: int) -> list:
+    '''
+    Create one SQL engine per shard
+    '''
+    return [create_engine(url_template.format(i), connect_args={'check_same_thread': False}) for i in range(shard_count)]
+
+
+# Shard SQL engines and sessions, empty when sharding is disabled
+shard_engines = create_shard_engines(SQLALCHEMY_SHARD_DATABASE_URL, SHARD_COUNT)
+ShardSessionLocals = [sessionmaker(autocommit=False, autoflush=False, bind=e) for e in shard_engines]
+
+# Engines that hold the VIN cache in the configured mode
+active_engines = shard_engines if SHARD_COUNT > 0 else [engine]
+
+
+class ShardedSession:
+    '''
+    Group of per shard sessions.
+    Sessions are only opened for the shards that are actually used
+    '''
+
+    def __init__(self, session_makers: list):
+        self.session_makers = session_makers
+        self.sessions = [None] * len(session_makers)
+
+    def shard(self, index: int) -> Session:
+        '''
+        Get the session for a shard index, opening it if needed
+        '''
+        if self.sessions[index] is None:
+            self.sessions[index] = self.session_makers[index]()
+
+        return self.sessions[index]
+
+    def for_vin(self, vin: str) -> Session:
+        '''
+        Get the session of the shard that holds a vin
+        '''
+        return self.shard(shard_for(vin, len(self.session_makers)))
+
+    def all(self) -> list:
+        '''
+        Get the sessions of every shard, for queries that fan out
+        '''
+        return [self.shard(i) for i in range(len(self.session_makers))]
+
+    def close(self):
+        for session in self.sessions:
+            if session is not None:
+                session.close()
+
+
+def new_session():
+    '''
+    Open a session for the configured storage mode.
+    Returns a ShardedSession when sharding is enabled, otherwise a plain Session
+    '''
+    if SHARD_COUNT > 0:
+        return ShardedSession(ShardSessionLocals)
+
+    return SessionLocal()
+
+
+def session_for(db, vin: str) -> Session:
+    '''
+    Session to use for a point operation on a vin.
+    Plain sessions are returned as is
+    '''
+    if isinstance(db, ShardedSession):
+        return db.for_vin(vin)
+
+    return db
+
+
+def sessions_of(db) -> list:
+    '''
+    Sessions to fan a batch query out to.
+    Plain sessions are returned as a single item list
+    '''
+    if isinstance(db, ShardedSession):
+        return db.all()
+
+    return [db]
+
+
+
+
 # For Testing
 
 # Test DB 
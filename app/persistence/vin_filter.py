@@ -0,0 +1,271 @@
+import math
+import os
+import struct
+from hashlib import blake2b
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from . import models
+from .database import sessions_of
+
+'''
+In memory counting bloom filter over the cached VINs.
+Lets the CRUD layer skip the SQLite query when a VIN is definitely not cached.
+Counters (instead of single bits) allow removals from /remove.
+The filter only sees writes made by this process, so it must only be enabled when a single process writes to the DB.
+'''
+
+# Skipping queries is opt in and for single process servers only.
+# WEB_CONCURRENCY is the only automatic check, uvicorn --workers and gunicorn -w do not set it
+FILTER_ENABLED = os.environ.get("VIN_FILTER_ENABLED", "0") == "1" and int(os.environ.get("WEB_CONCURRENCY", "1")) <= 1
+
+# Snapshot file path, written on shutdown and read (then deleted) on startup
+SNAPSHOT_PATH = "./vin_filter.snapshot"
+
+# Snapshot header: magic, num counters, num hashes, num items, DB fingerprint
+SNAPSHOT_MAGIC = b"VINCBF2\0"
+SNAPSHOT_HEADER = struct.Struct("<8sQQQ16s")
+
+# Sizing defaults
+DEFAULT_CAPACITY = 10000
+DEFAULT_FP_RATE = 0.01
+
+# Rows fetched per round trip when streaming the VINInfo table
+BUILD_BATCH_SIZE = 1000
+
+# 8 bit counters saturate at this value and are never decremented after
+COUNTER_MAX = 255
+
+
+class VINFilter:
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY, fp_rate: float = DEFAULT_FP_RATE):
+        '''
+        Size the filter for capacity items at the target false positive rate.
+        The filter is not ready until built or loaded, and answers "maybe" for everything until then.
+        '''
+
+        self.capacity = max(capacity, 1)
+        self.target_fp_rate = fp_rate
+
+        # Optimal number of counters and hash functions
+        self.num_counters = max(int(math.ceil(-self.capacity * math.log(fp_rate) / (math.log(2) ** 2))), 8)
+        self.num_hashes = max(int(round(self.num_counters / self.capacity * math.log(2))), 1)
+
+        self.counters = bytearray(self.num_counters)
+        self.count = 0
+        self.ready = False
+
+    def _positions(self, vin: str) -> list:
+        '''
+        Counter indexes for a vin using double hashing over a single blake2b digest
+        '''
+
+        digest = blake2b(vin.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+
+        return [(h1 + i * h2) % self.num_counters for i in range(self.num_hashes)]
+
+    def add(self, vin: str):
+        '''
+        Add a vin to the filter
+        '''
+
+        for pos in self._positions(vin):
+            if self.counters[pos] < COUNTER_MAX:
+                self.counters[pos] += 1
+
+        self.count += 1
+
+    def remove(self, vin: str):
+        '''
+        Remove a vin from the filter.
+        Only call this for vins that were actually added, otherwise other entries may turn into false negatives.
+        '''
+
+        for pos in self._positions(vin):
+            if 0 < self.counters[pos] < COUNTER_MAX:
+                self.counters[pos] -= 1
+
+        self.count = max(self.count - 1, 0)
+
+    def might_contain(self, vin: str) -> bool:
+        '''
+        Returns False only if the vin is definitely not cached.
+        Always returns True while the filter is not ready.
+        '''
+
+        if not self.ready:
+            return True
+
+        return all(self.counters[pos] for pos in self._positions(vin))
+
+    def reset(self):
+        '''
+        Clear all counters
+        '''
+
+        self.counters = bytearray(self.num_counters)
+        self.count = 0
+        self.ready = False
+
+    def fp_rate(self) -> float:
+        '''
+        Estimated false positive rate for the current number of items
+        '''
+
+        return (1 - math.exp(-self.num_hashes * self.count / self.num_counters)) ** self.num_hashes
+
+    def memory_bytes(self) -> int:
+        '''
+        Bytes used by the counter array
+        '''
+
+        return len(self.counters)
+
+    def stats(self) -> dict:
+        '''
+        Filter stats as a dict
+        '''
+
+        return {
+            "enabled": FILTER_ENABLED,
+            "ready": self.ready,
+            "items": self.count,
+            "capacity": self.capacity,
+            "num_counters": self.num_counters,
+            "num_hashes": self.num_hashes,
+            "memory_bytes": self.memory_bytes(),
+            "target_fp_rate": self.target_fp_rate,
+            "estimated_fp_rate": self.fp_rate(),
+        }
+
+    def save(self, path: str, fingerprint: bytes):
+        '''
+        Write the filter to a snapshot file.
+        fingerprint identifies the DB state at save time, used to detect a stale snapshot on load.
+        '''
+
+        # Write to a temp file first so a crash never leaves a half written snapshot
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, self.num_counters, self.num_hashes, self.count, fingerprint))
+            f.write(self.counters)
+
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, fingerprint: bytes):
+        '''
+        Read a filter from a snapshot file.
+        Returns None if the file is missing, corrupt or was saved with a different DB fingerprint.
+        '''
+
+        try:
+            with open(path, "rb") as f:
+                header = f.read(SNAPSHOT_HEADER.size)
+                magic, num_counters, num_hashes, count, saved_fingerprint = SNAPSHOT_HEADER.unpack(header)
+                counters = bytearray(f.read())
+
+        except (OSError, struct.error):
+            return None
+
+        if magic != SNAPSHOT_MAGIC or len(counters) != num_counters or saved_fingerprint != fingerprint:
+            return None
+
+        # Recover the capacity the snapshot was sized for
+        loaded = cls(capacity=round(num_counters * (math.log(2) ** 2) / -math.log(DEFAULT_FP_RATE)))
+        loaded.num_counters = num_counters
+        loaded.num_hashes = num_hashes
+        loaded.counters = counters
+        loaded.count = count
+        loaded.ready = True
+
+        return loaded
+
+    def replace_with(self, other):
+        '''
+        Take over the state of another filter in place so existing references see the new data
+        '''
+
+        self.__dict__.update(other.__dict__)
+
+
+# Shared filter used by the CRUD methods
+vin_filter = VINFilter()
+
+
+def count_rows(db: Session) -> int:
+    '''
+    VINInfo row count across every shard
+    '''
+
+    return sum(shard_db.query(models.VINInfo).count() for shard_db in sessions_of(db))
+
+
+def fingerprint(db: Session) -> bytes:
+    '''
+    Fingerprint of the DB state.
+    Hashes the row count and max rowid of every shard together with the size and mtime of its db file,
+    so any write after the snapshot was saved invalidates it
+    '''
+
+    digest = blake2b(digest_size=16)
+
+    for shard_db in sessions_of(db):
+        count, max_rowid = shard_db.execute(text('SELECT COUNT(*), MAX(rowid) FROM "{}"'.format(models.VINInfo.__tablename__))).one()
+        digest.update("{}:{}".format(count, max_rowid).encode())
+
+        path = shard_db.get_bind().url.database
+        if path and os.path.exists(path):
+            stat = os.stat(path)
+            digest.update("{}:{}".format(stat.st_size, stat.st_mtime_ns).encode())
+
+    return digest.digest()
+
+
+def build(db: Session, fp_rate: float = DEFAULT_FP_RATE) -> VINFilter:
+    '''
+    Rebuild the shared filter from the VINInfo table in a single streaming pass.
+    Sized for twice the current row count so the cache can grow before the fp rate degrades.
+    '''
+
+    row_count = count_rows(db)
+    new_filter = VINFilter(capacity=max(row_count * 2, DEFAULT_CAPACITY), fp_rate=fp_rate)
+
+    for shard_db in sessions_of(db):
+        for (vin,) in shard_db.query(models.VINInfo.vin).yield_per(BUILD_BATCH_SIZE):
+            new_filter.add(vin)
+
+    new_filter.ready = True
+    vin_filter.replace_with(new_filter)
+
+    return vin_filter
+
+
+def load_or_build(db: Session, path: str = SNAPSHOT_PATH) -> VINFilter:
+    '''
+    Load the shared filter from a snapshot if it matches the DB, otherwise rebuild it.
+    The snapshot is deleted once read so a crash can never leave a stale one behind
+    '''
+
+    loaded = VINFilter.load(path, fingerprint(db))
+
+    if os.path.exists(path):
+        os.remove(path)
+
+    if loaded is None:
+        return build(db)
+
+    vin_filter.replace_with(loaded)
+    return vin_filter
+
+
+def save_snapshot(db: Session, path: str = SNAPSHOT_PATH):
+    '''
+    Save the shared filter to a snapshot file if it is ready.
+    Only call this when this process is the only writer, otherwise the filter is missing other writers' vins
+    '''
+
+    if vin_filter.ready:
+        vin_filter.save(path, fingerprint(db))
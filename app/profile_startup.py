@@ -0,0 +1,164 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+'''
+Startup profile for the app.
+Starts a fresh interpreter, imports main, runs the startup events and serves a first request,
+then reports import time per module, time to first request and baseline RSS.
+With --check the run fails if any budget is exceeded, so it can gate CI.
+'''
+
+# Directory holding main.py, added to the child's sys.path
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Default budgets
+MAX_IMPORT_MS = 2000
+MAX_FIRST_REQUEST_MS = 3000
+MAX_RSS_MB = 150
+
+# Modules that must not be loaded before the first request, only /export needs them
+FORBIDDEN_MODULES = ['pandas', 'fastparquet', 'numpy']
+
+# Code run in the child interpreter, prints a JSON report on its last line of stdout
+CHILD_CODE = '''
+import json, resource, sys, time
+t0 = time.perf_counter()
+sys.path.insert(0, {app_dir!r})
+
+import main
+t_import = time.perf_counter()
+
+# Test client import is counted in the first request time, so it is an upper bound for a real worker
+from fastapi.testclient import TestClient
+with TestClient(main.app) as client:
+    # Remove on the empty temp DB goes through get_db and crud without calling vPIC
+    status = client.delete('/remove/1XPWD40X1ED215307').status_code
+    t_first = time.perf_counter()
+
+    # ru_maxrss is in KB on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rss_mb = rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+    loaded = [m for m in {forbidden!r} if m in sys.modules]
+
+print(json.dumps({{
+    'import_ms': (t_import - t0) * 1000,
+    'first_request_ms': (t_first - t0) * 1000,
+    'first_request_status': status,
+    'rss_mb': rss_mb,
+    'forbidden_loaded': loaded,
+}}))
+'''
+
+
+def parse_importtime(stderr: str) -> list:
+    '''
+    Parse python -X importtime output.
+    Returns a list of (module, self_us, cumulative_us) for every imported module
+    '''
+
+    modules = []
+
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules.append((name.strip(), int(self_us), int(cumulative_us)))
+
+    return modules
+
+
+def profile() -> dict:
+    '''
+    Run the child interpreter in a temp dir so the DB and snapshot files do not touch the working tree.
+    Returns the report as a dict
+    '''
+
+    code = CHILD_CODE.format(app_dir=APP_DIR, forbidden=FORBIDDEN_MODULES)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                                cwd=temp_dir, capture_output=True, text=True)
+
+    if result.returncode != 0:
+        raise Exception("Startup profile run failed.\n {}".format(result.stderr[-2000:]))
+
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    report['modules'] = parse_importtime(result.stderr)
+
+    return report
+
+
+def check_budget(report: dict, max_import_ms: float, max_first_request_ms: float, max_rss_mb: float) -> list:
+    '''
+    Compare a report against the budgets.
+    Returns a list of failure messages, empty if within budget
+    '''
+
+    failures = []
+
+    if report['import_ms'] > max_import_ms:
+        failures.append("import main took {:.0f} ms, budget {} ms".format(report['import_ms'], max_import_ms))
+
+    if report['first_request_ms'] > max_first_request_ms:
+        failures.append("first request took {:.0f} ms, budget {} ms".format(report['first_request_ms'], max_first_request_ms))
+
+    if report['rss_mb'] > max_rss_mb:
+        failures.append("baseline RSS is {:.1f} MB, budget {} MB".format(report['rss_mb'], max_rss_mb))
+
+    if report['first_request_status'] != 200:
+        failures.append("first request returned status {}".format(report['first_request_status']))
+
+    if report['forbidden_loaded']:
+        failures.append("modules loaded before first request: {}".format(", ".join(report['forbidden_loaded'])))
+
+    return failures
+
+
+def print_report(report: dict, top: int):
+    '''
+    Print the report in a readable format
+    '''
+
+    print("Startup profile")
+    print("  import main:       {:8.1f} ms".format(report['import_ms']))
+    print("  first request:     {:8.1f} ms".format(report['first_request_ms']))
+    print("  baseline RSS:      {:8.1f} MB".format(report['rss_mb']))
+    print()
+    print("Slowest imports (cumulative, includes nested imports)")
+
+    for name, self_us, cumulative_us in sorted(report['modules'], key=lambda m: m[2], reverse=True)[:top]:
+        print("  {:40} {:8.1f} ms".format(name, cumulative_us / 1000))
+
+
+# Entry
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Profile app startup and optionally check it against a budget")
+    parser.add_argument('--check', action='store_true', help="exit non zero if any budget is exceeded")
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    parser.add_argument('--top', type=int, default=15, help="number of imports to list")
+    parser.add_argument('--max-import-ms', type=float, default=MAX_IMPORT_MS)
+    parser.add_argument('--max-first-request-ms', type=float, default=MAX_FIRST_REQUEST_MS)
+    parser.add_argument('--max-rss-mb', type=float, default=MAX_RSS_MB)
+    args = parser.parse_args()
+
+    report = profile()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report, args.top)
+
+    if args.check:
+        failures = check_budget(report, args.max_import_ms, args.max_first_request_ms, args.max_rss_mb)
+
+        for failure in failures:
+            print("BUDGET EXCEEDED: {}".format(failure), file=sys.stderr)
+
+        sys.exit(1 if failures else 0)
@@ -0,0 +1,204 @@
+import argparse
+import os
+from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session, sessionmaker
+
+from persistence.models import Base, VINInfo
+from persistence.database import SHARD_COUNT, SQLALCHEMY_DATABASE_URL, SQLALCHEMY_SHARD_DATABASE_URL, shard_for, create_shard_engines
+from persistence.vin_filter import SNAPSHOT_PATH
+
+'''
+Reshard the VIN cache.
+Copies every VINInfo row from the single db file or an existing set of shards into a new set of shards.
+New shards are written next to their final path first and only moved into place once the copy succeeds.
+If moving them into place fails partway, the remaining .reshard files are kept and listed so the move can be finished by hand.
+The app must be stopped while resharding, writes made during the copy would be lost.
+'''
+
+# Rows read and inserted per batch
+BATCH_SIZE = 1000
+
+# Suffix of the shard files while they are being written
+TEMP_SUFFIX = ".reshard"
+
+
+def source_urls(from_shards: int, db_url: str, shard_url: str) -> list:
+    '''
+    Database urls to read from, the single db file when from_shards is 0
+    '''
+
+    if from_shards > 0:
+        return [shard_url.format(i) for i in range(from_shards)]
+
+    return [db_url]
+
+
+def check_paths(sources: list, final_paths: list, force: bool):
+    '''
+    Validate the source and target files before anything is written.
+    Raises if a source is missing or an existing shard outside the source set would be overwritten without force
+    '''
+
+    source_paths = [make_url(url).database for url in sources]
+
+    for url, path in zip(sources, source_paths):
+        if not os.path.exists(path):
+            raise FileNotFoundError("Source database not found: {}".format(url))
+
+    # Existing shards outside the source set may hold rows the source does not have
+    existing = [path for path in final_paths if os.path.exists(path) and path not in source_paths]
+    if existing and not force:
+        raise FileExistsError("Shard files would be overwritten: {}. Check --from-shards or pass --force".format(", ".join(existing)))
+
+
+def insert_batch(target: Session, batch: list) -> int:
+    '''
+    Insert a batch of rows into a target shard.
+    Returns the number of rows inserted
+    '''
+
+    target.bulk_insert_mappings(VINInfo, batch)
+    target.commit()
+
+    return len(batch)
+
+
+def copy_source(url: str, targets: list, counts: list):
+    '''
+    Stream every row of a source database into the target shard sessions, bucketing each batch by shard.
+    Adds the rows written to each shard to counts
+    '''
+
+    source_engine = create_engine(url)
+    source = sessionmaker(bind=source_engine)()
+    batches = [[] for _ in targets]
+
+    try:
+        for row in source.query(VINInfo).yield_per(BATCH_SIZE):
+            index = shard_for(row.vin, len(targets))
+            batches[index].append({column.name: getattr(row, column.name) for column in VINInfo.__table__.columns})
+
+            if len(batches[index]) >= BATCH_SIZE:
+                counts[index] += insert_batch(targets[index], batches[index])
+                batches[index] = []
+
+        for index, batch in enumerate(batches):
+            if batch:
+                counts[index] += insert_batch(targets[index], batch)
+
+    finally:
+        source.close()
+        source_engine.dispose()
+
+
+def copy_to_temp(sources: list, temp_url: str, temp_paths: list) -> list:
+    '''
+    Copy every source into new shards at the temp paths.
+    The temp shards are removed if the copy fails.
+    Returns the row count written to each shard
+    '''
+
+    for path in temp_paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+    target_engines = create_shard_engines(temp_url, len(temp_paths))
+    targets = [sessionmaker(autocommit=False, autoflush=False, bind=e)() for e in target_engines]
+    counts = [0] * len(temp_paths)
+    copied = False
+
+    try:
+        for target_engine in target_engines:
+            Base.metadata.create_all(bind=target_engine)
+
+        for url in sources:
+            copy_source(url, targets, counts)
+
+        copied = True
+
+    finally:
+        for target in targets:
+            target.close()
+
+        for target_engine in target_engines:
+            target_engine.dispose()
+
+        # Do not leave half written shards behind
+        if not copied:
+            for path in temp_paths:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    return counts
+
+
+def move_into_place(final_paths: list, temp_paths: list):
+    '''
+    Move the temp shards over the final shard paths.
+    If a move fails the remaining temp shards are kept and the error lists them so the move can be finished by hand
+    '''
+
+    try:
+        for path, temp_path in zip(final_paths, temp_paths):
+            os.replace(temp_path, path)
+
+    except OSError as e:
+        remaining = [path for path in temp_paths if os.path.exists(path)]
+        raise OSError("Moving the new shards into place failed, the shard files are now a mix of old and new. "
+                      "Recover by moving each of these over the file without the {} suffix: {}".format(TEMP_SUFFIX, ", ".join(remaining))) from e
+
+
+def reshard(to_shards: int, from_shards: int = SHARD_COUNT, db_url: str = SQLALCHEMY_DATABASE_URL,
+            shard_url: str = SQLALCHEMY_SHARD_DATABASE_URL, force: bool = False,
+            snapshot_path: str = SNAPSHOT_PATH) -> list:
+    '''
+    Copy the cache into to_shards shard files.
+    Refuses to overwrite existing shard files that are not being read from unless force is set.
+    Returns the row count written to each shard
+    '''
+
+    if to_shards < 1:
+        raise ValueError("to_shards must be at least 1")
+
+    sources = source_urls(from_shards, db_url, shard_url)
+    final_paths = [make_url(shard_url.format(i)).database for i in range(to_shards)]
+    check_paths(sources, final_paths, force)
+
+    # Write to temp files so the source shards can be read while the new ones are built
+    temp_paths = [path + TEMP_SUFFIX for path in final_paths]
+    counts = copy_to_temp(sources, shard_url + TEMP_SUFFIX, temp_paths)
+    move_into_place(final_paths, temp_paths)
+
+    # Drop old shards that are no longer part of the set
+    for i in range(to_shards, from_shards):
+        old_path = make_url(shard_url.format(i)).database
+        if os.path.exists(old_path):
+            os.remove(old_path)
+
+    # The VIN filter snapshot describes the old layout
+    if os.path.exists(snapshot_path):
+        os.remove(snapshot_path)
+
+    return counts
+
+
+# Entry
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Reshard the VIN cache into a new number of SQLite shard files")
+    parser.add_argument('to_shards', type=int, help="number of shards to write")
+    parser.add_argument('--from-shards', type=int, default=SHARD_COUNT, help="number of existing shards, 0 reads the single db file (default VIN_DB_SHARDS)")
+    parser.add_argument('--db-url', default=SQLALCHEMY_DATABASE_URL, help="single db file url")
+    parser.add_argument('--shard-url', default=SQLALCHEMY_SHARD_DATABASE_URL, help="shard url template, formatted with the shard index")
+    parser.add_argument('--force', action='store_true', help="overwrite existing shard files that are not being read from")
+    args = parser.parse_args()
+
+    print("Make sure the app is stopped, writes made while resharding are lost")
+
+    counts = reshard(args.to_shards, args.from_shards, args.db_url, args.shard_url, args.force)
+
+    for index, count in enumerate(counts):
+        print("shard {}: {} rows".format(index, count))
+
+    print("Set VIN_DB_SHARDS={} to use the new shards".format(args.to_shards))
@@ -1,4 +1,8 @@
 import io
+import os
+import sys
+import asyncio
+import subprocess
 import pytest
 import pandas as pd
 
@@ -6,6 +10,12 @@ from fastapi.testclient import TestClient
 from persistence.models import Base
 from persistence.schemas import VINInfoGet
 from persistence.database import test_engine, TestSessionLocal
+from persistence.database import ShardedSession, create_shard_engines, shard_for
+from persistence import crud, vin_filter
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+import reshard as reshard_tool
+from reshard import reshard
 from main import app, get_db
 
 
@@ -34,6 +44,10 @@ def setup_db():
     yield 
     Base.metadata.drop_all(bind=test_engine)
 
+# VIN DTO for tests that write to the DB directly through crud
+def vin_dto_for(vin: str) -> VINInfoGet:
+    return VINInfoGet(vin=vin, make='PETERBILT', model='388', model_year='2014', body_class='Truck-Tractor')
+
 
 
 ########### BEGIN TESTS ###########
@@ -340,4 +354,271 @@ def test_invalid_export_request(setup_db):
 
     # PUT request
     request = client.put('/export')
-    assert request.status_code == 405
\ No newline at end of file
+    assert request.status_code == 405
+
+
+########### VIN FILTER TESTS ###########
+
+# Valid vin that is not in the test DB unless a test adds it
+FILTER_VIN = '1XPWD40X1ED215307'
+
+@pytest.fixture()
+def filter_db(setup_db):
+    '''
+    Test DB session with the shared VIN filter built from the empty test DB.
+    Leaves the filter not ready afterwards so other tests always query the DB
+    '''
+    db = TestSessionLocal()
+    vin_filter.build(db)
+    yield db
+    vin_filter.vin_filter.reset()
+    db.close()
+
+
+def test_vin_filter_build(filter_db):
+    '''
+    Test building the filter from an empty DB.
+    It should be ready and report every vin as a definite miss
+    '''
+
+    assert vin_filter.vin_filter.ready == True
+    assert vin_filter.vin_filter.might_contain(FILTER_VIN) == False
+    assert client.get('/filter/stats').json()["items"] == 0
+
+
+def test_vin_filter_tracks_create_and_remove(filter_db):
+    '''
+    Test that creating a vin adds it to the filter and /remove takes it out again
+    '''
+
+    asyncio.run(crud.create_vin(filter_db, vin_dto_for(FILTER_VIN)))
+    assert vin_filter.vin_filter.might_contain(FILTER_VIN) == True
+
+    response = client.delete('/remove/{}'.format(FILTER_VIN))
+    assert response.json()["cache_delete_success"] == True
+    assert vin_filter.vin_filter.might_contain(FILTER_VIN) == False
+
+
+def test_vin_filter_stats(filter_db):
+    '''
+    Test that /filter/stats reports the items, memory use and fp rate
+    '''
+
+    asyncio.run(crud.create_vin(filter_db, vin_dto_for(FILTER_VIN)))
+
+    stats = client.get('/filter/stats').json()
+    assert stats["enabled"] == vin_filter.FILTER_ENABLED
+    assert stats["ready"] == True
+    assert stats["items"] == 1
+    assert stats["memory_bytes"] > 0
+    assert 0 <= stats["estimated_fp_rate"] <= stats["target_fp_rate"]
+
+
+def test_vin_filter_not_updated_when_not_ready(setup_db):
+    '''
+    Test that an unused filter is not updated by creates and removes
+    '''
+
+    db = TestSessionLocal()
+
+    try:
+        asyncio.run(crud.create_vin(db, vin_dto_for(FILTER_VIN)))
+        asyncio.run(crud.delete_vin(db, FILTER_VIN))
+        asyncio.run(crud.create_vin(db, vin_dto_for(FILTER_VIN)))
+
+        stats = client.get('/filter/stats').json()
+        assert stats["ready"] == False
+        assert stats["items"] == 0
+        assert stats["estimated_fp_rate"] == 0
+
+    finally:
+        db.close()
+
+
+def test_vin_filter_snapshot_round_trip(filter_db, tmp_path):
+    '''
+    Test that a snapshot keeps the vins and is deleted once read
+    '''
+
+    snapshot = str(tmp_path / "vin_filter.snapshot")
+    asyncio.run(crud.create_vin(filter_db, vin_dto_for(FILTER_VIN)))
+
+    vin_filter.save_snapshot(filter_db, snapshot)
+    vin_filter.vin_filter.reset()
+    vin_filter.load_or_build(filter_db, snapshot)
+
+    assert vin_filter.vin_filter.might_contain(FILTER_VIN) == True
+    assert not os.path.exists(snapshot)
+
+
+def test_vin_filter_stale_snapshot(filter_db, tmp_path):
+    '''
+    Test that a snapshot no longer matches once the DB changes, even with the same row count
+    '''
+
+    other_vin = '1XKWDB0X57J211825'
+    snapshot = str(tmp_path / "vin_filter.snapshot")
+    asyncio.run(crud.create_vin(filter_db, vin_dto_for(FILTER_VIN)))
+
+    vin_filter.save_snapshot(filter_db, snapshot)
+    saved = vin_filter.fingerprint(filter_db)
+
+    # Remove and add another vin so the row count stays the same
+    asyncio.run(crud.delete_vin(filter_db, FILTER_VIN))
+    asyncio.run(crud.create_vin(filter_db, vin_dto_for(other_vin)))
+    assert vin_filter.count_rows(filter_db) == 1
+
+    assert vin_filter.VINFilter.load(snapshot, vin_filter.fingerprint(filter_db)) is None
+    assert vin_filter.VINFilter.load(snapshot, saved) is not None
+
+
+def test_vin_filter_conflict_recovery(filter_db):
+    '''
+    Test that a vin cached behind the filter's back is returned instead of failing the insert
+    '''
+
+    asyncio.run(crud.create_vin(filter_db, vin_dto_for(FILTER_VIN)))
+
+    # Simulate a write the filter did not see
+    vin_filter.vin_filter.remove(FILTER_VIN)
+    assert vin_filter.vin_filter.might_contain(FILTER_VIN) == False
+
+    cached = asyncio.run(crud.create_vin(filter_db, vin_dto_for(FILTER_VIN)))
+
+    # Should be the cached record as a DTO and be back in the filter
+    cached_dto = vin_dto_for(FILTER_VIN)
+    cached_dto.cached_result = True
+    assert cached == cached_dto
+    assert vin_filter.vin_filter.might_contain(FILTER_VIN) == True
+
+
+
+########### STARTUP TESTS ###########
+def test_startup_skips_export_imports():
+    '''
+    Test that importing the app does not load the export stack.
+    pandas and fastparquet should only be imported by /export
+    '''
+
+    code = "import sys, main; print(','.join(m for m in ['pandas', 'fastparquet'] if m in sys.modules))"
+    result = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+
+    assert result.returncode == 0
+    assert result.stdout.strip() == ''
+
+
+
+########### SHARDING TESTS ###########
+def test_sharded_crud(tmp_path):
+    '''
+    Test point operations and export against a sharded cache.
+    Each vin should only land in its own shard and export should merge every shard
+    '''
+
+    vins = ['1XPWD40X1ED215307', '1XKWDB0X57J211825', '1XP5DB9X7YN526158', '4V4NC9EJXEN171694', '1XP5DB9X7XD487964']
+
+    shard_url = "sqlite:///" + str(tmp_path / "vin_shard_{}.db")
+    engines = create_shard_engines(shard_url, 3)
+    for engine in engines:
+        Base.metadata.create_all(bind=engine)
+
+    db = ShardedSession([sessionmaker(autocommit=False, autoflush=False, bind=e) for e in engines])
+
+    try:
+        for vin in vins:
+            asyncio.run(crud.create_vin(db, vin_dto_for(vin)))
+
+        # Each vin should be found and only stored in its own shard
+        for vin in vins:
+            assert asyncio.run(crud.get_by_vin(db, vin)) is not None
+            for index, shard_db in enumerate(db.all()):
+                assert (asyncio.run(crud.get_by_vin(shard_db, vin)) is not None) == (index == shard_for(vin, 3))
+
+        # Export should merge every shard
+        exported = asyncio.run(crud.export_db(db))
+        assert sorted(row[0] for row in exported) == sorted(vins)
+
+        # Delete should route to the right shard
+        assert asyncio.run(crud.delete_vin(db, vins[0])) == True
+        assert asyncio.run(crud.get_by_vin(db, vins[0])) is None
+
+    finally:
+        db.close()
+
+
+def test_reshard(tmp_path):
+    '''
+    Test resharding a single db file into shards and back down to fewer shards
+    '''
+
+    vins = ['1XPWD40X1ED215307', '1XKWDB0X57J211825', '1XP5DB9X7YN526158', '4V4NC9EJXEN171694', '1XP5DB9X7XD487964']
+
+    db_url = "sqlite:///" + str(tmp_path / "vin.db")
+    shard_url = "sqlite:///" + str(tmp_path / "vin_shard_{}.db")
+
+    # Populate the single db file
+    engine = create_engine(db_url)
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    for vin in vins:
+        asyncio.run(crud.create_vin(db, vin_dto_for(vin)))
+    db.close()
+
+    snapshot = tmp_path / "vin_filter.snapshot"
+    snapshot.write_bytes(b"stale")
+
+    # Missing source should fail without leaving temp shard files behind
+    with pytest.raises(FileNotFoundError):
+        reshard(2, 3, db_url, shard_url, snapshot_path=str(snapshot))
+    assert list(tmp_path.glob("*.reshard")) == []
+
+    # Single file to 4 shards, the filter snapshot should be removed
+    counts = reshard(4, 0, db_url, shard_url, snapshot_path=str(snapshot))
+    assert sum(counts) == len(vins)
+    assert counts == [sum(1 for vin in vins if shard_for(vin, 4) == i) for i in range(4)]
+    assert not os.path.exists(snapshot)
+
+    # Reading the single file again would overwrite the shards
+    with pytest.raises(FileExistsError):
+        reshard(4, 0, db_url, shard_url, snapshot_path=str(snapshot))
+
+    # 4 shards down to 2, the extra shard files should be removed
+    counts = reshard(2, 4, db_url, shard_url, snapshot_path=str(snapshot))
+    assert sum(counts) == len(vins)
+    assert os.path.exists(tmp_path / "vin_shard_1.db")
+    assert not os.path.exists(tmp_path / "vin_shard_2.db")
+
+
+def test_reshard_move_failure_keeps_temp_shards(tmp_path, monkeypatch):
+    '''
+    Test that a failure while moving the new shards into place keeps the remaining temp shards
+    and lists them in the error
+    '''
+
+    db_url = "sqlite:///" + str(tmp_path / "vin.db")
+    shard_url = "sqlite:///" + str(tmp_path / "vin_shard_{}.db")
+
+    engine = create_engine(db_url)
+    Base.metadata.create_all(bind=engine)
+    engine.dispose()
+
+    # Fail every move after the first one
+    moves = []
+    real_replace = os.replace
+
+    def failing_replace(src, dst):
+        if moves:
+            raise OSError("disk full")
+        moves.append(src)
+        real_replace(src, dst)
+
+    monkeypatch.setattr(reshard_tool.os, 'replace', failing_replace)
+
+    with pytest.raises(OSError) as error:
+        reshard(3, 0, db_url, shard_url, snapshot_path=str(tmp_path / "vin_filter.snapshot"))
+
+    remaining = sorted(str(path) for path in tmp_path.glob("*.reshard"))
+    assert len(remaining) == 2
+    for path in remaining:
+        assert path in str(error.value)
+